@@ -3,17 +3,21 @@
 
 import argparse
 import csv
+import json
 import logging
+import os
 import re
 import shutil
 from collections import defaultdict
 from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from datetime import date, datetime, timezone
-from functools import partial
+from functools import cache, partial
 from io import TextIOWrapper
 from operator import attrgetter, itemgetter
 from pathlib import Path
-from typing import cast
+from threading import Thread
+from typing import Any, cast
 from zipfile import ZipFile
 
 import requests
@@ -31,6 +35,7 @@ from impuls.tasks import (
 from impuls.tools import polish_calendar_exceptions
 from impuls.tools.color import text_color_for
 from impuls.tools.geo import earth_distance_m
+from requests.adapters import HTTPAdapter
 
 GTFS_HEADERS = {
     "agency.txt": (
@@ -154,7 +159,49 @@ ROUTE_COLORS = [
     ("46", 0, "#85bae5"),
 ]
 
+
+def compile_like_pattern(pattern: str) -> re.Pattern[str]:
+    """Compiles an SQL LIKE pattern into an equivalent regular expression,
+    to be used with fullmatch."""
+    regex = "".join(".*" if c == "%" else "." if c == "_" else re.escape(c) for c in pattern)
+    return re.compile(regex, re.IGNORECASE | re.DOTALL)
+
+
+# ROUTE_COLORS grouped by route type, as (short_name_regex, color, text_color) tuples.
+# Later rules take precedence over earlier ones, hence the reversed order.
+ROUTE_COLOR_RULES_BY_TYPE = {
+    route_type: [
+        (compile_like_pattern(short_name_pattern), color[1:], text_color_for(color))
+        for short_name_pattern, type, color in reversed(ROUTE_COLORS)
+        if type == route_type
+    ]
+    for route_type in {i[1] for i in ROUTE_COLORS}
+}
+
+
 UPPER_CASE_WORDS = ["GCR", "GPP", "II", "III", "NFZ", "PKP", "UG", "ZWM"]
+UPPER_CASE_WORDS_BY_KEY = {word.upper(): word for word in UPPER_CASE_WORDS}
+UPPER_CASE_WORDS_RE = re.compile(
+    r"\b(?:" + "|".join(map(re.escape, UPPER_CASE_WORDS)) + r")\b",
+    re.IGNORECASE,
+)
+
+PKG_DATE_RE = re.compile(r"[0-9]{4}\.[0-9]{2}\.[0-9]{2}")
+TIMEZONE_SUFFIX_RE = re.compile(r"(Z|[+-][0-9][0-9]:?[0-9][0-9])$")
+FEED_VERSION_RE = re.compile(r"_([0-9]+)_[0-9]{4}\.zip", re.IGNORECASE)
+
+MIN_DATETIME_UTC = datetime.min.replace(tzinfo=timezone.utc)
+MAX_DATE = Date(9999, 12, 31)
+
+MAX_WORKERS = 8
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+def write_json_atomically(path: Path, data: Any) -> None:
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        json.dump(data, f)
+    tmp_path.replace(path)
 
 
 class GZMFeedProvider(IntermediateFeedProvider[LocalResource]):
@@ -171,6 +218,12 @@ class GZMFeedProvider(IntermediateFeedProvider[LocalResource]):
         self.pkg_date = Date(1, 1, 1)
         self.feeds = list[Path]()
 
+        self.session = requests.Session()
+        self.session.mount(
+            "https://",
+            HTTPAdapter(pool_connections=MAX_WORKERS, pool_maxsize=MAX_WORKERS),
+        )
+
         self.logger = logging.getLogger(type(self).__name__)
 
     def prepare(self) -> None:
@@ -194,7 +247,7 @@ class GZMFeedProvider(IntermediateFeedProvider[LocalResource]):
         local_pkg, local_files = self._list_local_files()
         local_mod_time = max(
             (i[1] for i in local_files),
-            default=datetime.min.replace(tzinfo=timezone.utc),
+            default=MIN_DATETIME_UTC,
         )
 
         self.pkg_date = remote_pkg
@@ -205,23 +258,43 @@ class GZMFeedProvider(IntermediateFeedProvider[LocalResource]):
         return self.download_files(remote_files)
 
     def download_files(self, input: Iterable[tuple[str, str, datetime]]) -> list[Path]:
-        files = list[Path]()
         tmp_dir = self.dir.with_name(f"{self.dir.name}.new")
+        urls = list[str]()
+        tmp_files = list[Path]()
+        files = list[Path]()
+        for url, filename, _ in input:
+            if "/" in filename or "\\" in filename:
+                raise ValueError(f"unsafe gtfs filename: {filename!r}")
+            if not filename.endswith(".zip"):
+                raise ValueError(f"gtfs filename does not end in .zip: {filename!r}")
+            urls.append(url)
+            tmp_files.append(tmp_dir / filename)
+            files.append(self.dir / filename)
+
         tmp_dir.mkdir(parents=True)
         try:
-            for url, filename, _ in input:
-                if "/" in filename or "\\" in filename:
-                    raise ValueError(f"unsafe gtfs filename: {filename!r}")
-                if not filename.endswith(".zip"):
-                    raise ValueError(f"gtfs filename does not end in .zip: {filename!r}")
-                self.download_file(url, tmp_dir / filename)
-                files.append(self.dir / filename)
+            workers = min(MAX_WORKERS, max(1, len(urls)))
+            with ThreadPoolExecutor(max_workers=workers) as ex:
+                # Consume the iterator to re-raise any exceptions from the workers
+                list(ex.map(self.download_file, urls, tmp_files))
 
+            # Swap the directories with renames, and only remove the old files afterwards
+            old_dir = self.dir.with_name(f"{self.dir.name}.old")
             try:
-                shutil.rmtree(self.dir)
+                shutil.rmtree(old_dir)  # leftover from an interrupted run
             except FileNotFoundError:
                 pass
-            tmp_dir.rename(self.dir)
+
+            try:
+                os.replace(self.dir, old_dir)
+            except FileNotFoundError:
+                old_dir = None
+            os.replace(tmp_dir, self.dir)
+
+            # The daemon thread may be killed mid-way at interpreter exit. A partially removed
+            # <dir>.old is expected in that case, and is cleaned up on the next download.
+            if old_dir:
+                Thread(target=self._remove_old_dir, args=(old_dir,), daemon=True).start()
         finally:
             try:
                 shutil.rmtree(tmp_dir)
@@ -229,89 +302,231 @@ class GZMFeedProvider(IntermediateFeedProvider[LocalResource]):
                 pass
         return files
 
+    def _remove_old_dir(self, old_dir: Path) -> None:
+        try:
+            shutil.rmtree(old_dir)
+        except OSError:
+            self.logger.warning("Failed to remove %s", old_dir, exc_info=True)
+
     def download_file(self, url: str, dst: Path) -> None:
         self.logger.debug("Downloading %s", url)
-        with dst.open("wb") as f, requests.get(url, stream=True) as r:
+        with dst.open("wb") as f, self.session.get(url, stream=True) as r:
             r.raise_for_status()
-            for chunk in r.iter_content(chunk_size=None, decode_unicode=False):
-                f.write(chunk)
+            r.raw.decode_content = True
+            shutil.copyfileobj(r.raw, f, DOWNLOAD_CHUNK_SIZE)
 
     def _list_remote_files(self) -> defaultdict[date, list[tuple[str, str, datetime]]]:
         self.logger.info("Fetching remote resource list")
         files_by_pkg_date = defaultdict[date, list[tuple[str, str, datetime]]](list)
-        with requests.get(
+        data = self._get_json_cached(
             "https://otwartedane.metropoliagzm.pl/api/3/action/package_show",
             params={"id": "rozklady-jazdy-i-lokalizacja-przystankow-gtfs-wersja-rozszerzona"},
-        ) as r:
-            r.raise_for_status()
-            data = r.json()
-            for resource in data["result"]["resources"]:
-                if resource["mimetype"] != "application/zip":
-                    continue
+            cache_name="package_show",
+        )
+
+        # Bind frequently used callables to locals to avoid lookups in the loop
+        extract_pkg_date = self._extract_pkg_date
+        has_timezone = TIMEZONE_SUFFIX_RE.search
+        from_iso_format = datetime.fromisoformat
+        files_for_pkg_date = files_by_pkg_date.__getitem__
+
+        for resource in data["result"]["resources"]:
+            if resource["mimetype"] != "application/zip":
+                continue
 
-                url = resource["url"]
+            url = resource["url"]
 
-                name = resource["name"]
-                pkg_date_match = re.search(r"([0-9]{4})\.([0-9]{2})\.([0-9]{2})", name)
-                if not pkg_date_match:
-                    raise ValueError(f"failed to extract pkg date from {name!r}")
-                pkg_date = date(
-                    int(pkg_date_match[1]), int(pkg_date_match[2]), int(pkg_date_match[3])
-                )
+            name = resource["name"]
+            pkg_date = extract_pkg_date(name)
 
-                mod_time_str = resource["last_modified"]
-                if not re.search(r"(Z|[+-][0-9][0-9]:?[0-9][0-9])$", mod_time_str):
-                    # mod_time_str looks to have no timezone data, assume UTC (?)
-                    mod_time_str = f"{mod_time_str}Z"
-                mod_time = datetime.fromisoformat(mod_time_str)
-                assert mod_time.tzinfo is not None
+            mod_time_str = resource["last_modified"]
+            if not has_timezone(mod_time_str):
+                # mod_time_str looks to have no timezone data, assume UTC (?)
+                mod_time_str = f"{mod_time_str}Z"
+            mod_time = from_iso_format(mod_time_str)
+            assert mod_time.tzinfo is not None
 
-                files_by_pkg_date[pkg_date].append((url, name, mod_time))
+            files_for_pkg_date(pkg_date).append((url, name, mod_time))
         return files_by_pkg_date
 
+    def _get_json_cached(self, url: str, params: dict[str, str], cache_name: str) -> Any:
+        # The cache is kept next to self.dir, as self.dir is replaced on every download
+        cache_path = self.dir.with_name(f"{self.dir.name}.{cache_name}.json")
+        cached = self._load_response_cache(cache_path)
+
+        headers = dict[str, str]()
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached and cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
+        with self.session.get(url, params=params, headers=headers) as r:
+            if cached and r.status_code == 304:
+                self.logger.debug("%s not modified, using cached response", url)
+                return cached["data"]
+
+            r.raise_for_status()
+            data = json.loads(r.content)
+            etag = r.headers.get("ETag", "")
+            last_modified = r.headers.get("Last-Modified", "")
+
+        if etag or last_modified:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            write_json_atomically(
+                cache_path,
+                {"etag": etag, "last_modified": last_modified, "data": data},
+            )
+
+        return data
+
+    def _load_response_cache(self, path: Path) -> dict[str, Any] | None:
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return None
+        except ValueError:
+            cached = None
+
+        if isinstance(cached, dict):
+            cached = cast(dict[str, Any], cached)
+            if (
+                "data" in cached
+                and isinstance(cached.get("etag", ""), str)
+                and isinstance(cached.get("last_modified", ""), str)
+            ):
+                return cached
+
+        self.logger.warning("Ignoring corrupt response cache %s", path)
+        return None
+
     def _list_local_files(self) -> tuple[date, list[tuple[Path, datetime]]]:
         self.logger.info("Fetching local resource list")
         pkg_date = date.min
         files = list[tuple[Path, datetime]]()
 
-        for file in self.dir.glob("*.zip"):
-            m = re.search(r"([0-9]{4})\.([0-9]{2})\.([0-9]{2})", file.name)
-            if not m:
-                raise ValueError(f"failed to extract pkg date from {file.name!r}")
-            file_pkg_date = date(int(m[1]), int(m[2]), int(m[3]))
-            pkg_date = max(pkg_date, file_pkg_date)
+        try:
+            entries = os.scandir(self.dir)
+        except FileNotFoundError:
+            return pkg_date, files
+
+        with entries:
+            for entry in entries:
+                if not entry.name.endswith(".zip") or not entry.is_file():
+                    continue
 
-            mod_time = datetime.fromtimestamp(file.stat().st_mtime, timezone.utc)
-            files.append((file, mod_time))
+                pkg_date = max(pkg_date, self._extract_pkg_date(entry.name))
+
+                mod_time = datetime.fromtimestamp(entry.stat().st_mtime, timezone.utc)
+                files.append((Path(entry.path), mod_time))
 
         return pkg_date, files
 
     def needed(self) -> list[IntermediateFeed[LocalResource]]:
         self.prepare()
-        return [self.feed_for_file(f) for f in self.feeds]
 
-    def feed_for_file(self, file: Path) -> IntermediateFeed[LocalResource]:
+        start_dates_path = self.dir / ".start_dates.json"
+        cached_start_dates = self._load_start_dates(start_dates_path)
+
+        start_dates = cached_start_dates.copy()
+        with ThreadPoolExecutor(max_workers=min(MAX_WORKERS, max(1, len(self.feeds)))) as ex:
+            feeds = list(ex.map(partial(self.feed_for_file, start_dates=start_dates), self.feeds))
+
+        start_dates = {f.name: start_dates[f.name] for f in self.feeds}
+        if start_dates != cached_start_dates:
+            write_json_atomically(start_dates_path, start_dates)
+
+        return feeds
+
+    def feed_for_file(
+        self,
+        file: Path,
+        start_dates: dict[str, list[Any]],
+    ) -> IntermediateFeed[LocalResource]:
         return IntermediateFeed(
             resource=LocalResource(file),
             resource_name=file.name,
             version=self._get_version(file.name),
-            start_date=self._get_start_date(file),
+            start_date=self._get_cached_start_date(file, start_dates),
+        )
+
+    def _load_start_dates(self, path: Path) -> dict[str, list[Any]]:
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except ValueError:
+            self.logger.warning("Ignoring corrupt start date cache %s", path)
+            return {}
+
+        if not isinstance(cached, dict):
+            self.logger.warning("Ignoring corrupt start date cache %s", path)
+            return {}
+
+        # Silently drop malformed entries - they will be recomputed
+        return {
+            name: entry
+            for name, entry in cast(dict[str, Any], cached).items()
+            if self._is_valid_start_date_entry(entry)
+        }
+
+    @staticmethod
+    def _is_valid_start_date_entry(entry: Any) -> bool:
+        if not isinstance(entry, list) or len(cast(list[Any], entry)) != 3:
+            return False
+        mtime_ns, size, start_date = cast(list[Any], entry)
+        if not isinstance(mtime_ns, int) or not isinstance(size, int):
+            return False
+        if not isinstance(start_date, str):
+            return False
+        try:
+            Date.from_ymd_str(start_date)
+        except ValueError:
+            return False
+        return True
+
+    def _get_cached_start_date(self, file: Path, cache: dict[str, list[Any]]) -> Date:
+        # cache maps file names to [st_mtime_ns, st_size, start_date (YYYY-MM-DD)]
+        stat = file.stat()
+        cached = cache.get(file.name)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return Date.from_ymd_str(cached[2])
+
+        start_date = self._get_start_date(file)
+        cache[file.name] = [stat.st_mtime_ns, stat.st_size, str(start_date)]
+        return start_date
+
+    @staticmethod
+    def _extract_pkg_date(filename: str) -> date:
+        m = PKG_DATE_RE.search(filename)
+        if not m:
+            raise ValueError(f"failed to extract pkg date from {filename!r}")
+        i = m.start()
+        return date(
+            int(filename[i : i + 4]),
+            int(filename[i + 5 : i + 7]),
+            int(filename[i + 8 : i + 10]),
         )
 
     @staticmethod
     def _get_version(filename: str) -> str:
-        m = re.search(r"_([0-9]+)_[0-9]{4}\.zip", filename, re.IGNORECASE)
+        m = FEED_VERSION_RE.search(filename)
         if not m:
             raise ValueError(f"failed to extract feed_version from {filename!r}")
         return m[1]
 
     @staticmethod
     def _get_start_date(gtfs_zip: Path) -> Date:
-        start_date = Date(9999, 12, 31)  # date.max
+        # feed_info.txt has exactly one row - no need to read past it
         with ZipFile(gtfs_zip, "r") as arch, arch.open("feed_info.txt") as f:
-            for row in csv.DictReader(TextIOWrapper(f, "utf-8-sig", newline="")):
-                start_date = min(start_date, Date.from_ymd_str(row["feed_start_date"]))
-        return start_date
+            reader = csv.reader(TextIOWrapper(f, "utf-8-sig", newline=""))
+            try:
+                header = next(reader)
+                row = next(reader)
+            except StopIteration:
+                return MAX_DATE
+        return Date.from_ymd_str(row[header.index("feed_start_date")])
 
 
 class UpdateFeedInfo(Task):
@@ -328,33 +543,65 @@ class UpdateFeedInfo(Task):
             )
 
 
-class UpdateRouteColors(Task):
+class UpdateRouteShortNamesAndColors(Task):
     def execute(self, r: TaskRuntime) -> None:
+        # impuls doesn't provide a public way to register custom SQL functions
+        con = r.db._con  # pyright: ignore[reportPrivateUsage]
+        con.create_function("route_color", 2, self.route_color, deterministic=True)
+        con.create_function("route_text_color", 2, self.route_text_color, deterministic=True)
+
         with r.db.transaction():
-            r.db.raw_execute_many(
-                "UPDATE routes SET color = ?, text_color = ? WHERE type = ? AND short_name LIKE ?",
-                (
-                    (color[1:], text_color_for(color), type, short_name_pattern)
-                    for short_name_pattern, type, color in ROUTE_COLORS
-                ),
+            r.db.raw_execute(
+                "UPDATE routes SET short_name = substr(short_name, 2) "
+                "WHERE type = 0 AND short_name LIKE 'T%'"
+            )
+
+            # Routes which already have the correct colors are not touched
+            r.db.raw_execute(
+                "UPDATE routes SET color = route_color(type, short_name), "
+                "  text_color = route_text_color(type, short_name) "
+                "WHERE route_color(type, short_name) IS NOT NULL "
+                "  AND (color IS NOT route_color(type, short_name) "
+                "    OR text_color IS NOT route_text_color(type, short_name))"
             )
 
+    @staticmethod
+    def route_color(type: int, short_name: str) -> str | None:
+        colors = UpdateRouteShortNamesAndColors.match_colors(type, short_name)
+        return colors[0] if colors else None
+
+    @staticmethod
+    def route_text_color(type: int, short_name: str) -> str | None:
+        colors = UpdateRouteShortNamesAndColors.match_colors(type, short_name)
+        return colors[1] if colors else None
+
+    @staticmethod
+    @cache
+    def match_colors(type: int, short_name: str) -> tuple[str, str] | None:
+        for short_name_regex, color, text_color in ROUTE_COLOR_RULES_BY_TYPE.get(type, []):
+            if short_name_regex.fullmatch(short_name):
+                return color, text_color
+        return None
+
 
 class UpdateRouteLongNames(Task):
     def execute(self, r: TaskRuntime) -> None:
-        fixed = [
-            (self.fix_long_name(cast(str, i[1])), cast(str, i[0]))
-            for i in r.db.raw_execute("SELECT route_id, long_name FROM routes")
-        ]
+        # impuls doesn't provide a public way to register custom SQL functions
+        r.db._con.create_function(  # pyright: ignore[reportPrivateUsage]
+            "fix_long_name",
+            1,
+            self.fix_long_name,
+            deterministic=True,
+        )
         with r.db.transaction():
-            r.db.raw_execute_many("UPDATE routes SET long_name = ? WHERE route_id = ?", fixed)
+            r.db.raw_execute("UPDATE routes SET long_name = fix_long_name(long_name)")
 
     @staticmethod
     def fix_long_name(input: str) -> str:
-        s = input.title()
-        for word in UPPER_CASE_WORDS:
-            s = re.sub(f"\\b{re.escape(word)}\\b", word, s, flags=re.I)
-        return s
+        return UPPER_CASE_WORDS_RE.sub(
+            lambda m: UPPER_CASE_WORDS_BY_KEY[m[0].upper()],
+            input.title(),
+        )
 
 
 class DeduplicateStops(Task):
@@ -462,13 +709,6 @@ def create_final_pipeline(
             ),
             task_name="RemoveMunicipalityBorderFakeStops",
         ),
-        ExecuteSQL(
-            statement=(
-                "UPDATE routes SET short_name = substr(short_name, 2) "
-                "WHERE type = 0 AND short_name LIKE 'T%'"
-            ),
-            task_name="UpdateTramRouteShortName",
-        ),
         DeduplicateStops(),
         ExecuteSQL(
             statement=(
@@ -482,7 +722,7 @@ def create_final_pipeline(
             ),
             task_name="CleanStopCode",
         ),
-        UpdateRouteColors(),
+        UpdateRouteShortNamesAndColors(),
         UpdateRouteLongNames(),
         ExtendCalendarsFromPolishExceptions(
             resource_name="calendar_exceptions.csv",